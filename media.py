@@ -1,30 +1,39 @@
 import os
 import re
 import asyncio
+import html
+import json
+import signal
 import logging
-import psutil
 import uuid
 import time
-import math
 import configparser
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # orjson es opcional; json de la stdlib como respaldo
+    json_loads = json.loads
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.constants import ChatAction
+from telegram.error import RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
 )
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
-from google.auth.transport.requests import Request
+# Los módulos de Google se importan dentro de las funciones que los usan,
+# para no cargarlos al arrancar si no se llega a subir nada
 
 # --- Cargar Configuración ---
 config = configparser.ConfigParser()
-config.read('config.ini')
+if not config.read('config.ini'):
+    print("❌ Error: No se encuentra 'config.ini'. Por favor, crea el archivo con la configuración necesaria.")
+    exit()
 
 try:
     TOKEN = config['BOT']['TelegramToken']
@@ -33,10 +42,50 @@ except KeyError as e:
     print(f"❌ Error: La clave {e} no se encuentra en config.ini. Asegúrate de que el archivo esté completo.")
     exit()
 
+# Límites de concurrencia: descargas de yt-dlp y subidas a Drive por separado,
+# para que las descargas puedan hacer cola mientras terminan las subidas
+try:
+    MAX_CONCURRENT_DOWNLOADS = config.getint('BOT', 'MaxConcurrent', fallback=2)
+    MAX_CONCURRENT_UPLOADS = config.getint('GOOGLE', 'MaxConcurrentUploads', fallback=3)
+    if MAX_CONCURRENT_DOWNLOADS < 1 or MAX_CONCURRENT_UPLOADS < 1:
+        raise ValueError("debe ser un entero mayor o igual que 1")
+except ValueError as e:
+    print(f"❌ Error: MaxConcurrent/MaxConcurrentUploads inválido en config.ini ({e}).")
+    exit()
+DOWNLOAD_SEM = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+UPLOAD_SEM = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+# Hilos dedicados a las peticiones bloqueantes de Drive (una por subida activa),
+# para no competir con el executor por defecto que usa asyncio.to_thread
+_drive_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS, thread_name_prefix='drive-upload')
+
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 TOKEN_FILE = 'token.json'
 CREDENTIALS_FILE = 'credentials.json'
 
+# Límites para no saturar la API de Telegram con ediciones de progreso
+EDIT_MIN_INTERVAL = 3.0  # segundos entre ediciones
+EDIT_MIN_DELTA_PCT = 2   # puntos porcentuales mínimos entre ediciones
+
+DRIVE_HTTP_TIMEOUT = 60  # segundos por petición HTTP a Drive
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024  # múltiplo de 256 KB, menos PUTs por subida
+SMALL_UPLOAD_LIMIT = 5 * 1024 * 1024  # por debajo, subida simple sin sesión resumable
+# Los metadatos de yt-dlp contienen URLs firmadas que caducan; pasado este
+# tiempo se descartan y la descarga vuelve a extraerlos desde la URL
+INFO_JSON_MAX_AGE = 10 * 60  # segundos
+
+# Expresiones regulares precompiladas
+_MEDIASET_RE = re.compile(r'(/mpd-cenc\.ism)/(web|ctv)?(\.mpd)')
+_SAFE_NAME_RE = re.compile(r'[\\/*?:"<>|]')
+
+# Una línea de progreso por evento de yt-dlp, con valores numéricos en bytes:
+# dl:<descargado> <total> <velocidad> <ETA>  (los campos ausentes salen como NA)
+YTDLP_PROGRESS_TEMPLATE = (
+    'download:dl:%(progress.downloaded_bytes)d'
+    ' %(progress.total_bytes,progress.total_bytes_estimate)d'
+    ' %(progress.speed).0f %(progress._eta_str)s'
+)
+
 # --- Configuración de Logging ---
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -49,23 +98,83 @@ active_processes = {}
 task_data = {}
 progress_messages = {}
 
+# Servicio de Drive compartido entre tareas (se construye una sola vez)
+_drive_service = None
+_drive_lock = asyncio.Lock()
+
 # --- Funciones Auxiliares (sin cambios) ---
+# Las 21 barras posibles (0..20 celdas llenas), calculadas una sola vez
+_PROGRESS_BARS = tuple("█" * k + "░" * (20 - k) for k in range(21))
+
 def create_progress_bar(percentage: int) -> str:
-    return "".join(["█" if i < percentage // 5 else "░" for i in range(20)])
+    return _PROGRESS_BARS[max(0, min(20, percentage // 5))]
+
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
 
 def human_readable_size(size_bytes: int) -> str:
-    if size_bytes == 0: return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB")
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
-    return f"{s} {size_name[i]}"
+    size_bytes = int(size_bytes)  # la velocidad llega como float
+    if size_bytes <= 0: return "0B"
+    i = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (i * 10)):.2f} {_SIZE_UNITS[i]}"
+
+async def throttled_edit(msg, text: str, reply_markup, state: dict, pct: int,
+                         min_interval: float = EDIT_MIN_INTERVAL, min_delta_pct: int = EDIT_MIN_DELTA_PCT) -> bool:
+    """
+    Edita el mensaje de progreso solo si ha pasado el intervalo mínimo y el
+    porcentaje ha avanzado lo suficiente desde la última edición.
+    El texto se envía como HTML, igual que el resto de mensajes del bot.
+    Devuelve True si el mensaje se editó.
+    """
+    now = time.time()
+    if now - state.get('last_edit_ts', 0) < min_interval:
+        return False
+    if pct - state.get('last_pct', -min_delta_pct) < min_delta_pct:
+        return False
+    # Se registra antes de editar para que los fallos también queden limitados
+    state['last_edit_ts'] = now
+    state['last_pct'] = pct
+    try:
+        await msg.edit_text(text, reply_markup=reply_markup, parse_mode='HTML')
+    except RetryAfter as e:
+        logger.warning(f"Límite de Telegram alcanzado, esperando {e.retry_after}s antes de reintentar.")
+        await asyncio.sleep(e.retry_after)
+        await msg.edit_text(text, reply_markup=reply_markup, parse_mode='HTML')
+    return True
+
+def progress_template(header: str, name: str, body: str) -> str:
+    """
+    Plantilla HTML de progreso con el nombre ya escapado, para construirla una
+    vez por tarea y rellenar solo los valores en cada edición con str.format.
+    """
+    safe_name = html.escape(name).replace('{', '{{').replace('}', '}}')
+    return f"{header} <b>{safe_name}</b>\n\n{{bar}} {{pct}}%\n\n{body}"
+
+def prune_task_data():
+    """Libera los metadatos cacheados de los prompts de calidad ya caducados."""
+    now = time.time()
+    for info in task_data.values():
+        if info['info_json'] and now - info['created'] > INFO_JSON_MAX_AGE:
+            info['info_json'] = None
+
+def build_cancel_markup(task_id: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_{task_id}")]])
+
+def _write_bytes(path: str, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+async def remove_file(path: str) -> bool:
+    """Borra un archivo fuera del event loop. Devuelve False si no existía."""
+    try:
+        await asyncio.to_thread(os.unlink, path)
+        return True
+    except FileNotFoundError:
+        return False
 
 def transform_mediaset_url(url: str) -> str:
-    pattern = re.compile(r'(/mpd-cenc\.ism)/(web|ctv)?(\.mpd)')
-    if pattern.search(url):
+    if _MEDIASET_RE.search(url):
         logger.info(f"URL de Mediaset detectada, transformando a HLS: {url}")
-        return pattern.sub(r'/main.ism/picky.m3u8', url)
+        return _MEDIASET_RE.sub(r'/main.ism/picky.m3u8', url)
     return url
 
 # --- Autenticación y Subida a Drive (MEJORADO) ---
@@ -74,10 +183,16 @@ def authenticate_drive():
     Gestiona la autenticación con la API de Google Drive.
     Crea o refresca 'token.json' según sea necesario.
     """
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+    from googleapiclient.discovery import build
+    from googleapiclient.errors import HttpError
+
     creds = None
     if os.path.exists(TOKEN_FILE):
         try:
-            creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+            with open(TOKEN_FILE, 'rb') as token:
+                creds = Credentials.from_authorized_user_info(json_loads(token.read()), SCOPES)
         except Exception as e:
             logger.warning(f"El archivo {TOKEN_FILE} está corrupto o es inválido: {e}. Se solicitará nueva autenticación.")
             os.remove(TOKEN_FILE) # Eliminar token corrupto
@@ -99,6 +214,7 @@ def authenticate_drive():
                 print(f"Se necesita autenticación. Asegúrate de que '{CREDENTIALS_FILE}' está en esta carpeta.")
                 print("Se abrirá una ventana en tu navegador para que autorices el acceso a Google Drive.")
                 print("Una vez autorizado, se creará el archivo 'token.json' y el bot continuará.")
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
                 creds = flow.run_local_server(port=0)
             except FileNotFoundError:
@@ -114,44 +230,96 @@ def authenticate_drive():
         logger.info(f"Credenciales guardadas exitosamente en '{TOKEN_FILE}'.")
 
     try:
-        service = build('drive', 'v3', credentials=creds)
+        # static_discovery usa el documento incluido en el paquete (sin petición HTTP)
+        service = build('drive', 'v3', credentials=creds, cache_discovery=False, static_discovery=True)
         logger.info("Autenticación con Google Drive exitosa.")
         return service
     except HttpError as error:
         logger.error(f"Ocurrió un error al construir el servicio de Drive: {error}")
         return None
 
+async def run_drive_call(func, *args, **kwargs):
+    """Ejecuta una llamada bloqueante de googleapiclient en el executor de Drive."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_drive_executor, functools.partial(func, *args, **kwargs))
+
+async def get_drive_service():
+    """
+    Devuelve el servicio de Drive cacheado, autenticando solo la primera vez.
+    La renovación del token la hace AuthorizedHttp en cada petición.
+    """
+    global _drive_service
+    if _drive_service is not None:
+        return _drive_service
+    async with _drive_lock:
+        if _drive_service is None:
+            _drive_service = await asyncio.to_thread(authenticate_drive)
+    return _drive_service
+
 # El resto del código (upload_with_progress, download_and_upload_task, handlers, etc.)
 # permanece prácticamente igual que en tu script original. He añadido algunos logs
 # para mejor depuración en caso de errores al editar mensajes.
 # A continuación, el resto del código sin cambios funcionales importantes...
 
-async def upload_with_progress(msg, file_path: str, drive_file_name: str, task_id: str):
+async def upload_with_progress(msg, file_path: str, drive_file_name: str, task_id: str, cancel_markup: InlineKeyboardMarkup = None):
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import MediaFileUpload
+
+    upload_http = None
     try:
-        service = await asyncio.to_thread(authenticate_drive)
+        service = await get_drive_service()
         if not service:
             await msg.edit_text("❌ No se pudo autenticar con Google Drive. Revisa la consola del bot.")
             return None
 
         file_metadata = {'name': drive_file_name, 'parents': [DRIVE_FOLDER_ID]}
-        media = MediaFileUpload(file_path, mimetype='video/mp4', resumable=True)
+        small_file = os.path.getsize(file_path) < SMALL_UPLOAD_LIMIT
+        if small_file:
+            media = MediaFileUpload(file_path, mimetype='video/mp4', resumable=False)
+        else:
+            media = MediaFileUpload(file_path, mimetype='video/mp4', resumable=True, chunksize=UPLOAD_CHUNK_SIZE)
         
         logger.info(f"Iniciando subida de '{drive_file_name}' (Task ID: {task_id}) a Drive.")
         request = service.files().create(
             body=file_metadata, media_body=media, fields='id, webViewLink', supportsAllDrives=True
         )
 
+        # Conexión HTTP propia de esta subida: mantiene viva la sesión TLS entre
+        # chunks y no se comparte entre hilos (httplib2 no es thread-safe)
+        upload_http = AuthorizedHttp(request.http.credentials, http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+
+        if small_file:
+            if task_id not in progress_messages:
+                logger.info(f"Subida para la tarea {task_id} cancelada antes de empezar.")
+                return None
+            # Archivo pequeño: una sola petición multipart, sin inicio de sesión
+            return await run_drive_call(request.execute, http=upload_http)
+
         response = None
         last_uploaded_bytes = 0
         last_update_time = time.time()
-        cancel_button = [[InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_{task_id}")]]
+        if cancel_markup is None:
+            cancel_markup = build_cancel_markup(task_id)
+        edit_state = {}
+        total_size = media.size()
+        progress_tmpl = progress_template(
+            "📤 Subiendo:", drive_file_name,
+            f"Subido: {{up}} / {human_readable_size(total_size)}\nVelocidad: {{speed}}/s"
+        )
 
         while response is None:
-            if task_id not in active_processes and msg.message_id not in [m.message_id for m in progress_messages.values()]:
+            if task_id not in active_processes and task_id not in progress_messages:
                 logger.info(f"Subida para la tarea {task_id} cancelada externamente.")
                 return None
             
-            status, response = await asyncio.to_thread(request.next_chunk)
+            # AuthorizedHttp refresca el token y reintenta por sí mismo ante un 401,
+            # sin perder la sesión resumable
+            status, response = await run_drive_call(request.next_chunk, http=upload_http)
+            if task_id not in progress_messages:
+                # Cancelada mientras se enviaba el chunk: no pisar el mensaje de cancelación
+                logger.info(f"Subida para la tarea {task_id} cancelada durante el envío de un chunk.")
+                return None
             
             if status:
                 current_time = time.time()
@@ -159,22 +327,23 @@ async def upload_with_progress(msg, file_path: str, drive_file_name: str, task_i
                 bytes_since_last = status.resumable_progress - last_uploaded_bytes
                 
                 speed = bytes_since_last / elapsed_time if elapsed_time > 0 else 0
-                percentage = int(status.resumable_progress / media.size() * 100)
+                percentage = int(status.resumable_progress / total_size * 100)
                 
-                progress_text = (
-                    f"📤 Subiendo: *{drive_file_name}*\n\n"
-                    f"{create_progress_bar(percentage)} {percentage}%\n\n" 
-                    f"Subido: {human_readable_size(status.resumable_progress)} / {human_readable_size(media.size())}\n"
-                    f"Velocidad: {human_readable_size(speed)}/s" 
+                progress_text = progress_tmpl.format(
+                    bar=create_progress_bar(percentage), pct=percentage,
+                    up=human_readable_size(status.resumable_progress), speed=human_readable_size(speed)
                 )
                 
                 try:
-                    await msg.edit_text(progress_text, reply_markup=InlineKeyboardMarkup(cancel_button), parse_mode='Markdown')
+                    edited = await throttled_edit(msg, progress_text, cancel_markup, edit_state, percentage)
                 except Exception as e:
+                    edited = False
                     logger.warning(f"No se pudo actualizar progreso de subida para {task_id} (puede que el mensaje fuera borrado): {e}")
 
-                last_uploaded_bytes = status.resumable_progress
-                last_update_time = current_time
+                # La velocidad se mide entre ediciones visibles, no entre chunks
+                if edited:
+                    last_uploaded_bytes = status.resumable_progress
+                    last_update_time = current_time
         
         return response
 
@@ -182,69 +351,86 @@ async def upload_with_progress(msg, file_path: str, drive_file_name: str, task_i
         logger.error(f"Error durante la subida a Drive para tarea {task_id}: {e}", exc_info=True)
         if task_id in progress_messages:
             try:
-                await msg.edit_text(f"❌ Error al subir a Google Drive: *{drive_file_name}*.\n`{e}`", parse_mode='Markdown')
+                await msg.edit_text(
+                    f"❌ Error al subir a Google Drive: <b>{html.escape(drive_file_name)}</b>.\n<code>{html.escape(str(e))}</code>",
+                    parse_mode='HTML'
+                )
             except Exception: pass
         return None
+    finally:
+        if upload_http is not None:
+            upload_http.http.close()  # cerrar las conexiones keep-alive de esta subida
 
-async def download_and_upload_task(chat_id: int, url: str, quality_param: list, file_name: str, task_id: str, initial_msg: 'Message'):
+async def download_and_upload_task(chat_id: int, url: str, quality_param: list, file_name: str, task_id: str, initial_msg: 'Message', info_json: bytes = None, info_created: float = 0):
     output_filename = f"{file_name}.mp4"
-    cancel_button = [[InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_{task_id}")]]
+    info_filename = f"{task_id}.info.json"
+    cancel_markup = build_cancel_markup(task_id)  # mismo objeto para todas las ediciones de la tarea
+    progress_tmpl = progress_template(
+        "📥 Descargando:", file_name, "Tamaño: {total} | Velocidad: {speed}/s\nETA: {eta}"
+    )
 
     try:
+        status = "🕒 En cola" if DOWNLOAD_SEM.locked() else "⏳ Iniciando descarga de"
         await initial_msg.edit_text(
-            f"⏳ Iniciando descarga de: *{file_name}*", reply_markup=InlineKeyboardMarkup(cancel_button), parse_mode='Markdown'
+            f"{status}: <b>{html.escape(file_name)}</b>", reply_markup=cancel_markup, parse_mode='HTML'
         )
         
-        url_to_download = transform_mediaset_url(url) 
-        
         cmd_list = [
-            'yt-dlp', *quality_param, '--remux-video', 'mp4',
+            # Fusionar directamente en mp4 evita una segunda pasada de remux sobre el archivo completo
+            'yt-dlp', *quality_param, '--merge-output-format', 'mp4', '--remux-video', 'mp4',
             '--add-header', 'Origin: https://www.mediasetinfinity.es', 
             '--add-header', 'Referer: https://www.mediasetinfinity.es',
-            '-o', output_filename, url_to_download
+            '--newline', '--progress-template', YTDLP_PROGRESS_TEMPLATE,
+            '-o', output_filename
         ]
         
-        logger.info(f"Iniciando yt-dlp para Task ID {task_id}: {' '.join(cmd_list)}")
-        process = await asyncio.create_subprocess_exec(
-            *cmd_list, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        active_processes[task_id] = (process, output_filename)
-
-        buffer = ''
-        last_update_pct = -1
-        while True:
-            if task_id not in active_processes:
-                logger.info(f"Tarea {task_id} cancelada durante la descarga.")
-                break 
-
-            chunk = await process.stdout.read(1024)
-            if not chunk: break
-            buffer += chunk.decode('utf-8', errors='ignore')
-            
-            if '\r' in buffer:
-                last_line = buffer.split('\r')[-1]
-                match = re.search(
-                    r'\[download\]\s+([0-9.]+)\%\s+of\s+~?\s*([\d.]+\w+)\s+at\s+([\d.]+\w+/s)\s+ETA\s+([\d:]+)', last_line
+        async with DOWNLOAD_SEM:
+            if task_id not in progress_messages:
+                logger.info(f"Tarea {task_id} cancelada mientras esperaba en cola.")
+                return
+            # La edad se comprueba aquí y no al elegir calidad: la espera en cola
+            # puede hacer caducar las URLs firmadas de los metadatos
+            if info_json and time.time() - info_created <= INFO_JSON_MAX_AGE:
+                # Reutilizar los metadatos ya extraídos en /startmedia en lugar de volver a extraerlos
+                await asyncio.to_thread(_write_bytes, info_filename, info_json)
+                cmd_list += ['--load-info-json', info_filename]
+            else:
+                cmd_list.append(transform_mediaset_url(url))
+            logger.info(f"Iniciando yt-dlp para Task ID {task_id}: {' '.join(cmd_list)}")
+            process = await asyncio.create_subprocess_exec(
+                *cmd_list, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                start_new_session=True  # grupo propio para poder cancelar también a ffmpeg
+            )
+            active_processes[task_id] = (process, output_filename)
+
+            edit_state = {}
+            async for raw in process.stdout:
+                if task_id not in active_processes:
+                    logger.info(f"Tarea {task_id} cancelada durante la descarga.")
+                    break 
+
+                line = raw.decode('utf-8', errors='ignore').strip()
+                if not line.startswith('dl:'):
+                    continue
+                try:
+                    downloaded_str, total_str, speed_str, eta_str = line[3:].split()
+                    downloaded, total = int(downloaded_str), int(total_str)
+                except ValueError:
+                    continue  # tamaño aún desconocido (NA)
+                if total <= 0:
+                    continue
+                speed = int(speed_str) if speed_str.isdigit() else 0
+                pct = min(downloaded * 100 // total, 100)
+                progress_text = progress_tmpl.format(
+                    bar=create_progress_bar(pct), pct=pct,
+                    total=human_readable_size(total), speed=human_readable_size(speed), eta=eta_str
                 )
-                if match:
-                    pct = int(float(match.group(1)))
-                    if pct > last_update_pct:
-                        last_update_pct = pct
-                        progress_text = (
-                            f"📥 Descargando: *{file_name}*\n\n"
-                            f"{create_progress_bar(pct)} {pct}%\n\n"
-                            f"Tamaño: {match.group(2)} | Velocidad: {match.group(3)}\n"
-                            f"ETA: {match.group(4)}"
-                        )
-                        try:
-                            await initial_msg.edit_text(
-                                progress_text, reply_markup=InlineKeyboardMarkup(cancel_button), parse_mode='Markdown'
-                            )
-                        except Exception as e:
-                            logger.warning(f"No se pudo actualizar progreso de descarga para {task_id}: {e}")
-                buffer = buffer.split('\r')[-1]
+                try:
+                    await throttled_edit(initial_msg, progress_text, cancel_markup, edit_state, pct)
+                except Exception as e:
+                    logger.warning(f"No se pudo actualizar progreso de descarga para {task_id}: {e}")
         
-        await process.wait() 
+            await process.wait()
 
         if task_id not in active_processes:
             logger.info(f"Tarea {task_id} cancelada tras la descarga.")
@@ -253,8 +439,23 @@ async def download_and_upload_task(chat_id: int, url: str, quality_param: list,
         active_processes.pop(task_id, None)
 
         if process.returncode == 0 and os.path.exists(output_filename):
-            await initial_msg.edit_text(f"✅ Descarga completa: *{file_name}*\n\n📤 Preparando subida...", parse_mode='Markdown')
-            uploaded_file = await upload_with_progress(initial_msg, output_filename, output_filename, task_id)
+            if UPLOAD_SEM.locked():
+                # La subida no empieza enseguida: mostrar que está en cola en lugar de
+                # dejar el último progreso de descarga congelado
+                await initial_msg.edit_text(
+                    f"🕒 En cola para subir: <b>{html.escape(file_name)}</b>", reply_markup=cancel_markup, parse_mode='HTML'
+                )
+            else:
+                # La primera edición de progreso de la subida reemplaza al mensaje de descarga
+                try:
+                    await initial_msg.get_bot().send_chat_action(chat_id, ChatAction.UPLOAD_VIDEO)
+                except Exception as e:
+                    logger.warning(f"No se pudo enviar la acción de chat para {task_id}: {e}")
+            async with UPLOAD_SEM:
+                if task_id not in progress_messages:
+                    logger.info(f"Tarea {task_id} cancelada mientras esperaba para subir.")
+                    return
+                uploaded_file = await upload_with_progress(initial_msg, output_filename, output_filename, task_id, cancel_markup)
 
             if uploaded_file:
                 file_id = uploaded_file.get('id')
@@ -264,28 +465,36 @@ async def download_and_upload_task(chat_id: int, url: str, quality_param: list,
                     [InlineKeyboardButton("🔗 Mirror Link", url=f"https://worker-withered-breeze-c480.jostynv.workers.dev/0:findpath?id={file_id}")]
                 ]
                 await initial_msg.edit_text(
-                    f"✅ ¡Completado!\n\n🎬 **Título:** `{file_name}`",
-                    reply_markup=InlineKeyboardMarkup(buttons), parse_mode='Markdown', disable_web_page_preview=True
+                    f"✅ ¡Completado!\n\n🎬 <b>Título:</b> <code>{html.escape(file_name)}</code>",
+                    reply_markup=InlineKeyboardMarkup(buttons), parse_mode='HTML', disable_web_page_preview=True
                 )
         else:
             stderr_text = (await process.stderr.read()).decode('utf-8', 'ignore').strip()
             if task_id in progress_messages:
-                await initial_msg.edit_text(f"❌ Error en la descarga de *{file_name}*.\n`{stderr_text[:1000]}`", parse_mode='Markdown')
+                await initial_msg.edit_text(
+                    f"❌ Error en la descarga de <b>{html.escape(file_name)}</b>.\n<code>{html.escape(stderr_text[:1000])}</code>",
+                    parse_mode='HTML'
+                )
 
     except Exception as e:
         logger.error(f"Error general en la tarea (Task ID {task_id}): {e}", exc_info=True)
         if task_id in progress_messages:
-            await initial_msg.edit_text(f"❌ Error inesperado para *{file_name}*.\n`{e}`", parse_mode='Markdown')
+            try:
+                await initial_msg.edit_text(
+                    f"❌ Error inesperado para <b>{html.escape(file_name)}</b>.\n<code>{html.escape(str(e))}</code>",
+                    parse_mode='HTML'
+                )
+            except Exception: pass
     finally:
         progress_messages.pop(task_id, None)
-        if os.path.exists(output_filename):
-            os.remove(output_filename)
+        if await remove_file(output_filename):
             logger.info(f"Archivo temporal '{output_filename}' eliminado para Task ID {task_id}.")
+        await remove_file(info_filename)
 
 async def startmedia_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # (Esta función y las siguientes no necesitan cambios)
     if not context.args:
-        await update.message.reply_text("⚠️ Uso: `/startmedia <URL> [nombre_opcional]`", parse_mode='Markdown')
+        await update.message.reply_text("⚠️ Uso: <code>/startmedia &lt;URL&gt; [nombre_opcional]</code>", parse_mode='HTML')
         return
     url = context.args[0]
     if not re.match(r'https?://', url):
@@ -293,30 +502,34 @@ async def startmedia_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     if len(context.args) > 1:
         custom_name = " ".join(context.args[1:]).strip()
-        safe_filename = re.sub(r'[\\/*?:"<>|]', "", custom_name)
+        safe_filename = _SAFE_NAME_RE.sub("", custom_name)
+        info_json = None
     else:
-        status_msg = await update.message.reply_text("🔎 Obteniendo título del video...")
         try:
+            await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
             url_for_title = transform_mediaset_url(url)
-            get_title_cmd = [
-                'yt-dlp', '--get-title', '--no-warnings',
+            # -J extrae todos los metadatos (título y formatos) una sola vez;
+            # la descarga los reutiliza con --load-info-json
+            get_info_cmd = [
+                'yt-dlp', '-J', '--skip-download', '--no-warnings',
                 '--add-header', 'Origin: https://www.mediasetinfinity.es',
                 '--add-header', 'Referer: https://www.mediasetinfinity.es',
                 url_for_title
             ]
-            proc_title = await asyncio.create_subprocess_exec(
-                *get_title_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            proc_info = await asyncio.create_subprocess_exec(
+                *get_info_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
             )
-            stdout_title, stderr_title = await proc_title.communicate()
-            if proc_title.returncode != 0:
-                error = stderr_title.decode('utf-8', errors='ignore')
-                await status_msg.edit_text(f"❌ No se pudo obtener el título.\n`{error[:1000]}`", parse_mode='Markdown')
+            info_json, stderr_info = await proc_info.communicate()
+            if proc_info.returncode != 0:
+                error = stderr_info.decode('utf-8', errors='ignore')
+                await update.message.reply_text(
+                    f"❌ No se pudo obtener el título.\n<code>{html.escape(error[:1000])}</code>", parse_mode='HTML'
+                )
                 return
-            filename_base = stdout_title.decode('utf-8', errors='ignore').strip()
-            safe_filename = re.sub(r'[\\/*?:"<>|]', "", filename_base)
-            await status_msg.delete()
+            filename_base = json_loads(info_json).get('title', '').strip()
+            safe_filename = _SAFE_NAME_RE.sub("", filename_base)
         except Exception as e:
-            await status_msg.edit_text(f"❌ Error al obtener título:\n`{e}`", parse_mode='Markdown')
+            await update.message.reply_text(f"❌ Error al obtener título:\n<code>{html.escape(str(e))}</code>", parse_mode='HTML')
             return
 
     task_id = str(uuid.uuid4())
@@ -327,11 +540,13 @@ async def startmedia_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         [InlineKeyboardButton("480p", callback_data=f"quality_480_{task_id}")],
     ]
     sent_msg = await update.message.reply_text(
-        f"🎬 *{safe_filename}*\n\n📐 Elige la calidad para la descarga:",
-        reply_markup=InlineKeyboardMarkup(buttons), parse_mode='Markdown'
+        f"🎬 <b>{html.escape(safe_filename)}</b>\n\n📐 Elige la calidad para la descarga:",
+        reply_markup=InlineKeyboardMarkup(buttons), parse_mode='HTML'
     )
+    prune_task_data()
     task_data[sent_msg.message_id] = {
-        'url': url, 'filename': safe_filename, 'task_id': task_id, 'initial_msg': sent_msg
+        'url': url, 'filename': safe_filename, 'task_id': task_id, 'initial_msg': sent_msg,
+        'info_json': info_json, 'created': time.time()
     }
 
 async def quality_selection_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -342,12 +557,13 @@ async def quality_selection_handler(update: Update, context: ContextTypes.DEFAUL
     if not task_info:
         await query.edit_message_text("⌛️ Este botón ha expirado. Inicia una nueva descarga.")
         return
-    url, file_name, task_id, initial_msg = task_info.values()
+    url, file_name, task_id, initial_msg = task_info['url'], task_info['filename'], task_info['task_id'], task_info['initial_msg']
+    info_json, info_created = task_info['info_json'], task_info['created']
     quality = query.data.split('_')[1]
     quality_param = ['-f', 'bestvideo+bestaudio/best'] if quality == "best" else ['-f', f'bestvideo[height<={quality}]+bestaudio/best[height<={quality}]']
     progress_messages[task_id] = initial_msg
     asyncio.create_task(
-        download_and_upload_task(query.message.chat.id, url, quality_param, file_name, task_id, initial_msg)
+        download_and_upload_task(query.message.chat.id, url, quality_param, file_name, task_id, initial_msg, info_json, info_created)
     )
 
 async def cancel_any_download(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -358,31 +574,54 @@ async def cancel_any_download(update: Update, context: ContextTypes.DEFAULT_TYPE
     msg_to_edit = progress_messages.pop(task_id, None)
     if process_info:
         process, filename = process_info
-        try:
-            parent = psutil.Process(process.pid)
-            for child in parent.children(recursive=True): child.terminate()
-            parent.terminate()
-            await process.wait()
+        if await kill_process_group(process):
             logger.info(f"Proceso para tarea {task_id} cancelado.")
-        except psutil.NoSuchProcess:
+        else:
             logger.warning(f"Proceso para tarea {task_id} ya no existía.")
-        if os.path.exists(filename):
-            os.remove(filename)
+        await remove_file(filename)
         if msg_to_edit:
-            await msg_to_edit.edit_text(f"❌ Descarga cancelada: *{os.path.basename(filename).replace('.mp4', '')}*", parse_mode='Markdown')
+            await msg_to_edit.edit_text(
+                f"❌ Descarga cancelada: <b>{html.escape(os.path.basename(filename).replace('.mp4', ''))}</b>", parse_mode='HTML'
+            )
     elif msg_to_edit:
-        await msg_to_edit.edit_text("❓ Descarga ya finalizada o cancelada.")
+        # Sin proceso activo pero con mensaje: la tarea estaba en cola o subiendo a Drive
+        await msg_to_edit.edit_text("❌ Tarea cancelada.")
     else:
         await query.edit_message_text("❓ No se encontró una descarga activa.")
 
+async def kill_process_group(process) -> bool:
+    """
+    Termina yt-dlp y sus hijos (ffmpeg), que corren en su propio grupo de procesos.
+    Devuelve False si el proceso ya no existía.
+    """
+    try:
+        pgid = os.getpgid(process.pid)
+        os.killpg(pgid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), 5)
+        except asyncio.TimeoutError:
+            os.killpg(pgid, signal.SIGKILL)
+            await process.wait()
+        return True
+    except ProcessLookupError:
+        return False
+
+async def shutdown_cleanup(application):
+    """
+    Al apagar el bot, termina las descargas en curso: al tener sesión propia
+    no reciben la señal (Ctrl+C, SIGTERM) enviada al bot.
+    """
+    for task_id, (process, filename) in list(active_processes.items()):
+        active_processes.pop(task_id, None)
+        if await kill_process_group(process):
+            logger.info(f"Proceso para tarea {task_id} terminado al apagar el bot.")
+        await remove_file(filename)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error("Excepción al manejar una actualización:", exc_info=context.error)
 
 def main():
-    if not os.path.exists('config.ini'):
-        print("❌ Error: No se encuentra 'config.ini'. Por favor, crea el archivo con la configuración necesaria.")
-        return
-    application = ApplicationBuilder().token(TOKEN).build()
+    application = ApplicationBuilder().token(TOKEN).post_shutdown(shutdown_cleanup).build()
     application.add_handler(CommandHandler('startmedia', startmedia_command))
     application.add_handler(CallbackQueryHandler(quality_selection_handler, pattern=r'^quality_(best|\d+)'))
     application.add_handler(CallbackQueryHandler(cancel_any_download, pattern=r'^cancel_'))
@@ -393,4 +632,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-    main()
\ No newline at end of file